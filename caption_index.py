@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import lzma
+import sqlite3
+import logging
+import argparse
+from datetime import datetime
+
+from layout import DATE_PREFIX
+from metadata_store import STORE_NAME, iter_posts
+
+# Index file shared by all scrapers
+CAPTION_INDEX = 'caption_index.sqlite'
+
+HASHTAG = re.compile(r'#(\w+)')
+MENTION = re.compile(r'@([\w.]+\w)')
+
+# Search terms: "quoted phrases" or runs of non-space characters
+QUERY_TERM = re.compile(r'"[^"]*"|\S+')
+FTS_OPERATORS = ('AND', 'OR', 'NOT')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    shortcode TEXT UNIQUE NOT NULL,
+    username TEXT NOT NULL,
+    date_utc TEXT,
+    caption TEXT
+);
+CREATE INDEX IF NOT EXISTS posts_username_date ON posts (username, date_utc);
+CREATE INDEX IF NOT EXISTS posts_date ON posts (date_utc);
+CREATE TABLE IF NOT EXISTS tags (
+    post_id INTEGER NOT NULL REFERENCES posts (id),
+    kind TEXT NOT NULL,  -- '#' for hashtags, '@' for mentions
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_kind_tag ON tags (kind, tag);
+CREATE INDEX IF NOT EXISTS tags_post ON tags (post_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS captions USING fts5 (caption);
+'''
+
+_connection = None  # Lazily opened connection to CAPTION_INDEX used by index_post
+
+def open_index(path=CAPTION_INDEX):
+    """Open (and create if needed) a caption index."""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+def add_post(conn, username, shortcode, date_utc, caption):
+    """Insert or update one post in the index (the caller commits)."""
+    caption = caption or ''
+    date_text = date_utc.strftime('%Y-%m-%d %H:%M:%S') if date_utc else None
+    row = conn.execute('SELECT id FROM posts WHERE shortcode = ?', (shortcode,)).fetchone()
+    if row:
+        post_id = row[0]
+        conn.execute('UPDATE posts SET username = ?, date_utc = ?, caption = ? WHERE id = ?',
+                     (username, date_text, caption, post_id))
+        conn.execute('DELETE FROM captions WHERE rowid = ?', (post_id,))
+        conn.execute('DELETE FROM tags WHERE post_id = ?', (post_id,))
+    else:
+        post_id = conn.execute('INSERT INTO posts (shortcode, username, date_utc, caption) VALUES (?, ?, ?, ?)',
+                               (shortcode, username, date_text, caption)).lastrowid
+    conn.execute('INSERT INTO captions (rowid, caption) VALUES (?, ?)', (post_id, caption))
+    tags = {('#', tag.lower()) for tag in HASHTAG.findall(caption)}
+    tags |= {('@', name.lower()) for name in MENTION.findall(caption)}
+    conn.executemany('INSERT INTO tags (post_id, kind, tag) VALUES (?, ?, ?)',
+                     [(post_id, kind, tag) for kind, tag in tags])
+
+def index_post(username, shortcode, date_utc, caption):
+    """Add a freshly downloaded post to the shared caption index; never fails the download."""
+    global _connection
+    try:
+        if _connection is None:
+            _connection = open_index()
+        add_post(_connection, username, shortcode, date_utc, caption)
+        _connection.commit()
+    except Exception as e:
+        logging.error(f"Failed to index caption of {shortcode}: {e}")
+
+def read_sidecar(json_path):
+    """Return (shortcode, caption) from an Instaloader .json.xz/.json metadata file."""
+    opener = lzma.open if json_path.endswith('.xz') else open
+    with opener(json_path, 'rt', encoding='utf-8') as f:
+        node = json.load(f).get('node', {})
+    shortcode = node.get('shortcode') or node.get('code')
+    caption = None
+    edges = node.get('edge_media_to_caption', {}).get('edges')
+    if edges:
+        caption = edges[0]['node']['text']
+    elif isinstance(node.get('caption'), dict):
+        caption = node['caption'].get('text')
+    return shortcode, caption
+
+def backfill(conn, root):
+    """Index the posts already on disk from Instaloader's .txt captions and .json.xz metadata (or packed store)."""
+    indexed = skipped = 0
+    for username in sorted(os.listdir(root)):
+        user_dir = os.path.join(root, username)
+        if not os.path.isdir(user_dir):
+            continue
+        if os.path.isfile(os.path.join(user_dir, STORE_NAME)):
+            # Posts whose metadata is packed into the user's store
+            for shortcode, media_dir, prefix, date_utc, caption, structure in iter_posts(user_dir):
+                add_post(conn, username, shortcode, date_utc, caption)
+                indexed += 1
+        for dirpath, dirnames, filenames in os.walk(user_dir):
+            names = set(filenames)
+            for filename in filenames:
+                match = DATE_PREFIX.match(filename)
+                if not match or not (filename.endswith('.json.xz') or filename.endswith('.json')):
+                    continue
+                prefix = filename.split('.', 1)[0]
+                try:
+                    shortcode, caption = read_sidecar(os.path.join(dirpath, filename))
+                    if f"{prefix}.txt" in names:
+                        # The .txt file is what Instaloader wrote as caption, prefer it
+                        with open(os.path.join(dirpath, f"{prefix}.txt"), 'r', encoding='utf-8') as f:
+                            caption = f.read()
+                except Exception as e:
+                    logging.warning(f"Could not read metadata of {filename}: {e}")
+                    skipped += 1
+                    continue
+                if not shortcode:
+                    skipped += 1
+                    continue
+                add_post(conn, username, shortcode, datetime(*map(int, match.groups())), caption)
+                indexed += 1
+        conn.commit()
+        logging.debug(f"Backfilled captions of {username}.")
+    print(f"Indexed {indexed} posts ({skipped} metadata files skipped).")
+
+def parse_query(text):
+    """Split a search text into an FTS5 query and the #hashtags and @mentions in it.
+
+    Every word and "phrase" is quoted as an FTS5 string, so punctuation such as
+    foo-bar or don't is matched as text instead of being read as query syntax;
+    a trailing * keeps its prefix meaning and AND/OR/NOT stay operators.
+    """
+    terms, tags = [], []
+    for term in QUERY_TERM.findall(text):
+        if term[0] in '#@' and len(term) > 1:
+            tags.append((term[0], term[1:]))
+        elif term in FTS_OPERATORS:
+            terms.append(term)
+        else:
+            prefix = term.endswith('*') and len(term) > 1
+            word = term[:-1] if prefix else term
+            if word.startswith('"') and word.endswith('"') and len(word) > 1:
+                word = word[1:-1]
+            terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms), tags
+
+def search(conn, text=None, hashtag=None, mention=None, username=None, since=None, until=None, limit=50):
+    """Return (username, shortcode, date, caption) of the posts matching all given filters, newest first.
+
+    `text` holds words, "phrases", prefix* terms and AND/OR/NOT (see
+    parse_query); #hashtags and @mentions in it are looked up like `hashtag`
+    and `mention`. `since` and `until` are dates (YYYY-MM-DD) bounding the
+    post date.
+    """
+    query = 'SELECT p.username, p.shortcode, p.date_utc, p.caption FROM posts p'
+    conditions, params = [], []
+    fts_query, tags = parse_query(text or '')
+    if fts_query:
+        query += ' JOIN captions c ON c.rowid = p.id'
+        conditions.append('captions MATCH ?')
+        params.append(fts_query)
+    tags += [(kind, tag) for kind, tag in (('#', hashtag), ('@', mention)) if tag]
+    for kind, tag in tags:
+        conditions.append('p.id IN (SELECT post_id FROM tags WHERE kind = ? AND tag = ?)')
+        params += [kind, tag.lstrip(kind).lower()]
+    if username:
+        conditions.append('p.username = ?')
+        params.append(username)
+    if since:
+        conditions.append('p.date_utc >= ?')
+        params.append(since)
+    if until:
+        conditions.append('p.date_utc < date(?, \'+1 day\')')
+        params.append(until)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY p.date_utc DESC LIMIT ?'
+    params.append(limit)
+    return conn.execute(query, params).fetchall()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Full-text index over the captions of the downloaded posts.")
+    parser.add_argument('--index', default=CAPTION_INDEX, help="Index database file")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help="Index the posts already downloaded")
+    backfill_parser.add_argument('--root', default='downloads', help="Downloads root holding one directory per username")
+    search_parser = subparsers.add_parser('search', help="Search the captions")
+    search_parser.add_argument('text', nargs='?', help="Full-text query")
+    search_parser.add_argument('--hashtag', help="Only posts with this hashtag")
+    search_parser.add_argument('--mention', help="Only posts mentioning this account")
+    search_parser.add_argument('--user', help="Only posts of this username")
+    search_parser.add_argument('--since', help="Only posts from this date on (YYYY-MM-DD)")
+    search_parser.add_argument('--until', help="Only posts up to this date (YYYY-MM-DD)")
+    search_parser.add_argument('--limit', type=int, default=50, help="Maximum number of results")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    conn = open_index(args.index)
+    if args.command == 'backfill':
+        backfill(conn, args.root)
+    else:
+        try:
+            results = search(conn, args.text, args.hashtag, args.mention, args.user, args.since, args.until, args.limit)
+        except sqlite3.OperationalError as e:
+            # Whatever quoting cannot fix, e.g. a query made of operators only
+            print(f"Invalid search query {args.text!r}: {e}")
+            results = []
+        for username, shortcode, date_utc, caption in results:
+            print(f"{date_utc}  {username}  https://www.instagram.com/p/{shortcode}/")
+            print(f"    {' '.join(caption.split())[:200]}")
+        print(f"{len(results)} posts found.")
+    conn.close()
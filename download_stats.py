@@ -0,0 +1,32 @@
+import os
+import logging
+
+def post_files(L, target_dir, post):
+    """Return the paths of the files Instaloader wrote for the given post."""
+    prefix = os.path.basename(L.format_filename(post, target=target_dir))
+    return [os.path.join(target_dir, file) for file in os.listdir(target_dir) if file.startswith(prefix)]
+
+def new_run_summary():
+    """Return the empty counts of a run over several users."""
+    return {'users': 0, 'failed_users': 0, 'posts': 0, 'files': 0,
+            'saved_posts': 0, 'saved_files': 0, 'lost_files': 0}
+
+def update_run_summary(summary, stats):
+    """Add the counts of one user to the run summary."""
+    summary['users'] += 1
+    summary['posts'] += stats['posts']
+    summary['files'] += stats['files']
+    if stats['failed']:
+        summary['failed_users'] += 1
+        summary['saved_posts'] += stats['posts']
+        summary['saved_files'] += stats['files']
+        summary['lost_files'] += stats['lost_files']
+
+def print_run_summary(summary):
+    """Report how much work was committed and how much was lost on failures."""
+    print(f"Committed {summary['posts']} posts ({summary['files']} files) for {summary['users']} accounts.")
+    if summary['failed_users']:
+        print(f"{summary['failed_users']} accounts failed part way: {summary['saved_posts']} posts "
+              f"({summary['saved_files']} files) were saved before the failure, "
+              f"{summary['lost_files']} files of interrupted posts were not logged.")
+    logging.info(f"Run summary: {summary}")
@@ -0,0 +1,164 @@
+import os
+import csv
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import instaloader
+
+from download_stats import post_files
+from preview import PREVIEW_MANIFEST, PREVIEW_SUFFIX, download_preview, read_manifests
+
+# Size and checksum of every committed file; the File Path column is in the same place as in
+# the download logs so migrate_layout.py can rewrite it the same way
+INTEGRITY_MANIFEST = 'integrity_manifest.csv'
+MANIFEST_HEADER = ["Username", "Shortcode", "File Path", "Size", "SHA256"]
+
+# Suffix of broken files set aside while their post is downloaded again
+BROKEN_SUFFIX = '.broken'
+
+def file_sha256(path):
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def record_files(logs, manifest_path=INTEGRITY_MANIFEST):
+    """Append the size and checksum of the files in the given log rows to the manifest."""
+    try:
+        file_exists = os.path.isfile(manifest_path)
+        with open(manifest_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if not file_exists:
+                writer.writerow(MANIFEST_HEADER)
+            for username, shortcode, file_path, *_ in logs:
+                writer.writerow([username, shortcode, file_path, os.path.getsize(file_path), file_sha256(file_path)])
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        logging.error(f"Failed to record checksums: {e}")
+
+def read_manifest(manifest_path=INTEGRITY_MANIFEST):
+    """Return the latest manifest entry of every recorded file, by path."""
+    entries = {}
+    if not os.path.isfile(manifest_path):
+        return entries
+    with open(manifest_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            entries[row['File Path']] = row
+    return entries
+
+def check_file(entry):
+    """Return 'ok', 'missing' or 'broken' for one manifest entry."""
+    path = entry['File Path']
+    if not os.path.isfile(path):
+        return 'missing'
+    # The size catches truncated files without reading them
+    if os.path.getsize(path) != int(entry['Size']) or file_sha256(path) != entry['SHA256']:
+        return 'broken'
+    return 'ok'
+
+def remove_partial_downloads(root):
+    """Delete the .temp files Instaloader leaves behind when a download is interrupted."""
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith('.temp'):
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+    if removed:
+        logging.info(f"Removed {removed} partial downloads.")
+    return removed
+
+def find_broken_files(manifest_path=INTEGRITY_MANIFEST, workers=8):
+    """Check every recorded file against its size and checksum in parallel; returns the broken entries."""
+    entries = list(read_manifest(manifest_path).values())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(check_file, entries))
+    broken = [entry for entry, result in zip(entries, results) if result == 'broken']
+    missing = results.count('missing')
+    logging.info(f"Integrity check: {len(entries)} files recorded, {len(broken)} broken, {missing} missing.")
+    if missing:
+        # Missing files may have been moved or deleted on purpose, so they are not fetched again
+        logging.debug(f"{missing} recorded files no longer exist.")
+    return broken
+
+def restore_broken_files(paths):
+    """Move set-aside broken files back unless a new download replaced them; returns the number restored."""
+    restored = 0
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(f"{path}{BROKEN_SUFFIX}")
+        else:
+            os.replace(f"{path}{BROKEN_SUFFIX}", path)
+            restored += 1
+    return restored
+
+def restore_interrupted_repairs(root):
+    """Put back the broken files a repair set aside before it was interrupted, so they are queued again."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(BROKEN_SUFFIX):
+                paths.append(os.path.join(dirpath, filename[:-len(BROKEN_SUFFIX)]))
+    if paths:
+        logging.info(f"Restored {restore_broken_files(paths)} broken files of an interrupted repair.")
+
+def repair_broken_files(L, root='downloads', manifest_path=INTEGRITY_MANIFEST, workers=8, stop_requested=None):
+    """Run the startup integrity pass and download the posts of broken files again.
+
+    A broken file is only replaced once its post was downloaded again, so posts
+    that cannot be fetched now stay queued for the next start. `stop_requested`
+    is polled between posts to end the repair early.
+    """
+    restore_interrupted_repairs(root)
+    remove_partial_downloads(root)
+    broken = find_broken_files(manifest_path, workers)
+    if not broken:
+        return 0
+
+    # Queue each post once, with the directory its broken files are in; previews of preview mode
+    # are queued apart so they are stored as preview again instead of as full media
+    queue = {}
+    for entry in broken:
+        logging.warning(f"Broken file, queued for re-download: {entry['File Path']}")
+        is_preview = os.path.splitext(os.path.basename(entry['File Path']))[0].endswith(PREVIEW_SUFFIX)
+        username, target_dir, paths = queue.setdefault(
+            (entry['Shortcode'], is_preview), (entry['Username'], os.path.dirname(entry['File Path']), []))
+        paths.append(entry['File Path'])
+    previews = read_manifests(root) if any(is_preview for shortcode, is_preview in queue) else {}
+
+    repaired = 0
+    for (shortcode, is_preview), (username, target_dir, paths) in queue.items():
+        if stop_requested is not None and stop_requested():
+            logging.info("Repair stopped on user request; the remaining posts are retried on the next start.")
+            break
+        preview = previews.get(shortcode) if is_preview else None
+        if is_preview and (preview is None or preview['Source'] != 'instaloader'):
+            logging.warning(f"No preview of {shortcode} recorded in its preview manifest, not repairing it.")
+            continue
+        # Instaloader skips files that already exist, so the broken ones are set aside meanwhile
+        for path in paths:
+            os.replace(path, f"{path}{BROKEN_SUFFIX}")
+        try:
+            post = instaloader.Post.from_shortcode(L.context, shortcode)
+            if is_preview:
+                download_preview(L, post, preview['Media Dir'], target_dir,
+                                 os.path.join(root, username, PREVIEW_MANIFEST))
+            else:
+                L.download_post(post, target=target_dir)
+        except instaloader.exceptions.TooManyRequestsException:
+            restore_broken_files(paths)
+            logging.warning("Rate limited while repairing; the remaining posts are retried on the next start.")
+            break
+        except Exception as e:
+            restore_broken_files(paths)
+            logging.error(f"Failed to re-download {shortcode}: {e}")
+            continue
+        restore_broken_files(paths)  # Drops the set-aside copies the download replaced
+        record_files([[username, shortcode, file_path] for file_path in post_files(L, target_dir, post)], manifest_path)
+        repaired += 1
+    print(f"Re-downloaded {repaired} of {len(queue)} posts with broken files.")
+    return repaired
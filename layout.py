@@ -0,0 +1,31 @@
+import os
+import re
+from datetime import datetime
+
+# Directory layout used below each media directory (downloads/{username}, .../images, .../videos):
+#   flat      - all files directly in the media directory (the original layout)
+#   month     - one subdirectory per year and month of the post, e.g. images/2024/05
+#   shortcode - one subdirectory per first two characters of the shortcode, e.g. images/Cx
+LAYOUTS = ('flat', 'month', 'shortcode')
+
+# Layout used by all writers; set DOWNLOAD_LAYOUT to switch (then run migrate_layout.py on existing trees)
+LAYOUT = os.environ.get('DOWNLOAD_LAYOUT', 'flat')
+
+# Instaloader's default filename pattern starts with the post date: 2024-05-01_12-30-00_UTC
+DATE_PREFIX = re.compile(r'^(\d{4})-(\d{2})-(\d{2})_(\d{2})-(\d{2})-(\d{2})_UTC')
+
+def shard_dir(media_dir, shortcode, date_utc=None, layout=None):
+    """Return the directory a post's files go to below the given media directory.
+
+    `date_utc` is the post date; when it is unknown the current time is used,
+    which matches the file modification time the migration falls back to.
+    """
+    layout = layout or LAYOUT
+    if layout == 'month':
+        date = date_utc or datetime.utcnow()
+        return os.path.join(media_dir, f"{date:%Y}", f"{date:%m}")
+    if layout == 'shortcode':
+        return os.path.join(media_dir, shortcode[:2])
+    if layout == 'flat':
+        return media_dir
+    raise ValueError(f"Unknown download layout: {layout}")
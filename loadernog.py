@@ -7,17 +7,37 @@ import random
 import sys
 import signal
 
+from caption_index import index_post
+from download_stats import new_run_summary, post_files, print_run_summary, update_run_summary
+from integrity import record_files, repair_broken_files
+from layout import shard_dir
+from metadata_store import INSTALOADER_OPTIONS, PACKED_METADATA, store_post
+from preview import PREVIEW_MANIFEST, PREVIEW_MODE, download_preview
+
 # Initialize Instaloader instance
-L = instaloader.Instaloader()
+L = instaloader.Instaloader(**INSTALOADER_OPTIONS)
+
+# Handle graceful shutdowns: the first Ctrl-C lets the current post finish, the second aborts
+shutdown_requested = False
 
-# Handle graceful shutdowns
 def signal_handler(sig, frame):
-    print("\nExiting gracefully...")
-    logging.info("Script terminated by user.")
-    sys.exit(0)
+    global shutdown_requested
+    if shutdown_requested:
+        logging.info("Script aborted by user.")
+        print("\nAborting...")
+        sys.exit(1)
+    shutdown_requested = True
+    logging.info("Shutdown requested by user.")
+    print("\nFinishing the current post before exiting (press Ctrl-C again to abort)...")
 
 signal.signal(signal.SIGINT, signal_handler)
 
+def sleep_unless_shutdown(seconds):
+    """Sleep for the given time, waking up early once a shutdown was requested with Ctrl-C."""
+    end = time.time() + seconds
+    while not shutdown_requested and time.time() < end:
+        time.sleep(min(1, end - time.time()))
+
 def create_directory(path):
     """Create directory if it doesn't exist."""
     if not os.path.exists(path):
@@ -37,13 +57,33 @@ def log_to_csv(log_file_path, logs):
                 writer.writerow(["Username", "Shortcode", "File Path", "Timestamp"])
             for log in logs:
                 writer.writerow(log)
+            # Make sure the rows survive a crash right after this call
+            file.flush()
+            os.fsync(file.fileno())
         logging.debug(f"Successfully logged {len(logs)} entries to CSV file.")
     except Exception as e:
         logging.error(f"Failed to log to CSV file: {e}")
 
-def download_user_posts(username):
-    """Download the last 50 posts from the given Instagram username."""
-    logs = []
+def download_user_posts(username, stats, max_posts=50, since=None, wait_on_rate_limit=True, profile=None):
+    """Download the last `max_posts` posts from the given Instagram username.
+
+    This is a generator: the log rows of each post are yielded as soon as the
+    post is complete so the caller can commit them right away. Counts of the
+    committed and lost work are kept in `stats`.
+
+    If `since` (a naive UTC datetime) is given, stop at the first post that is
+    not newer than it; pinned posts are skipped instead since they are listed
+    first regardless of their date. `max_posts` then limits the posts newly
+    downloaded, and posts already on disk (from a run that stopped at the
+    limit) are passed over. `stats['complete']` tells whether the walk got to
+    `since` or the end of the feed; `stats['walked']` counts the posts listed.
+
+    With `wait_on_rate_limit` off, a rate limit is raised to the caller instead
+    of waiting it out here. A `profile` the caller already looked up is reused.
+    """
+    stats.update({'posts': 0, 'files': 0, 'lost_files': 0, 'failed': False, 'interrupted': False,
+                  'complete': False, 'walked': 0})
+    in_flight = None  # (target_dir, post) of the post currently being downloaded
     try:
         logging.debug(f"Starting download for {username}...")
         print(f"Starting download for {username}...")
@@ -57,14 +97,24 @@ def download_user_posts(username):
         create_directory(video_dir)
 
         # Get profile from username
-        profile = instaloader.Profile.from_username(L.context, username)
+        if profile is None:
+            profile = instaloader.Profile.from_username(L.context, username)
 
-        # Download the latest 50 posts
-        total_files = 0
+        # Download the latest posts
         posts = profile.get_posts()
         for idx, post in enumerate(posts):
-            if idx >= 50:  # Limit to last 50 posts
+            if (idx if since is None else stats['posts']) >= max_posts:  # Limit to max_posts posts
+                break
+            if shutdown_requested:
+                logging.info(f"Stopping {username} early on user request.")
+                stats['interrupted'] = True
                 break
+            stats['walked'] += 1
+            if since is not None and post.date_utc <= since:
+                if post.is_pinned:
+                    continue
+                stats['complete'] = True
+                break  # Everything from here on was already downloaded
 
             # Define paths for different file types
             if post.typename == 'GraphImage':  # It's an image post
@@ -73,29 +123,53 @@ def download_user_posts(username):
                 target_dir = video_dir
             else:
                 target_dir = base_dir  # If it's another type, use the base directory
-
-            # Download post media to the target directory
-            L.download_post(post, target=target_dir)
-
-            # Log the downloaded file data (will log later to CSV)
-            for file in os.listdir(target_dir):
-                if file.startswith(post.shortcode):
-                    file_path = os.path.join(target_dir, file)
-                    logs.append([username, post.shortcode, file_path, time.strftime('%Y-%m-%d %H:%M:%S')])
-                    total_files += 1
-
-        logging.debug(f"Finished downloading for {username}. Total files: {total_files}")
-        print(f"Finished downloading for {username}. Total files: {total_files}")
+            media_dir = target_dir
+            target_dir = shard_dir(media_dir, post.shortcode, post.date_utc)
+            create_directory(target_dir)
+            if since is not None and post_files(L, target_dir, post):
+                continue  # Downloaded by an earlier run that stopped at max_posts
+
+            # Download post media (or only its preview) to the target directory
+            in_flight = (target_dir, post)
+            if PREVIEW_MODE:
+                download_preview(L, post, media_dir, target_dir, os.path.join(base_dir, PREVIEW_MANIFEST))
+            else:
+                L.download_post(post, target=target_dir)
+            if PACKED_METADATA:
+                store_post(L, post, base_dir, media_dir)
+            index_post(username, post.shortcode, post.date_utc, post.caption)
+
+            # Hand the downloaded file data to the caller to be logged right away
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+            logs = [[username, post.shortcode, file_path, timestamp] for file_path in post_files(L, target_dir, post)]
+            record_files(logs)  # Sizes and checksums for the startup integrity check
+            yield logs
+            in_flight = None
+            stats['posts'] += 1
+            stats['files'] += len(logs)
+        else:
+            stats['complete'] = True  # Reached the oldest post
+
+        logging.debug(f"Finished downloading for {username}. Total files: {stats['files']}")
+        print(f"Finished downloading for {username}. Total files: {stats['files']}")
 
     except instaloader.exceptions.TooManyRequestsException as e:
-        logging.warning(f"Rate limited for {username}. Retrying in 10 minutes...")
-        time.sleep(600)  # Sleep for 10 minutes before retrying
-        return None
+        stats['failed'] = True
+        if not wait_on_rate_limit:
+            raise  # The caller schedules its own pause
+        logging.warning(f"Rate limited for {username} after {stats['posts']} posts. Retrying in 10 minutes...")
+        sleep_unless_shutdown(600)  # Sleep for 10 minutes before retrying
     except Exception as e:
-        logging.error(f"Error downloading posts for {username}: {e}")
-        return None
-
-    return logs  # Return the logs for this user to be written to CSV
+        stats['failed'] = True
+        logging.error(f"Error downloading posts for {username} after {stats['posts']} posts: {e}")
+    finally:
+        if stats['failed'] and in_flight is not None:
+            # Whatever the interrupted post left on disk was never logged
+            target_dir, post = in_flight
+            try:
+                stats['lost_files'] = len(post_files(L, target_dir, post))
+            except Exception as e:
+                logging.debug(f"Could not count the files of the interrupted post: {e}")
 
 def read_usernames_from_csv(file_path):
     """Read Instagram usernames from a CSV file."""
@@ -146,13 +220,14 @@ def get_scraping_time_range():
 
 def countdown(seconds):
     """Display a countdown timer."""
-    while seconds:
+    while seconds and not shutdown_requested:
         mins, secs = divmod(seconds, 60)
         time_format = f'{mins:02d}:{secs:02d}'
         print(f"Next scrape in: {time_format}", end='\r')
         time.sleep(1)
         seconds -= 1
-    print("\nScraping next account...")
+    if not shutdown_requested:
+        print("\nScraping next account...")
 
 if __name__ == "__main__":
     # Set up logging
@@ -176,19 +251,28 @@ if __name__ == "__main__":
         # Get the time range for random sleep intervals
         min_sleep_time, max_sleep_time = get_scraping_time_range()
 
+        # Check the media of earlier runs and download broken files again
+        repair_broken_files(L, stop_requested=lambda: shutdown_requested)
+
         # Randomly shuffle usernames for each run
         random.shuffle(usernames)
         print(f"Shuffled usernames: {usernames}")
 
+        run_summary = new_run_summary()
+
         # Loop through each username
         for username in usernames:
             print(f"Scraping {username}...")
-            logs = download_user_posts(username)
-
-            if logs:
-                log_to_csv(log_csv_file, logs)  # Log to CSV file after scraping the user
-            else:
-                logging.error(f"Failed to scrape or log for {username}.")
+            stats = {}
+            for logs in download_user_posts(username, stats):
+                if logs:
+                    log_to_csv(log_csv_file, logs)  # Log to CSV file as soon as each post is done
+
+            update_run_summary(run_summary, stats)
+            if stats['failed']:
+                logging.error(f"Failed to scrape {username}; {stats['posts']} posts were logged before the failure.")
+            if shutdown_requested:
+                break
 
             # Add a random sleep time between each download (human-like behavior)
             sleep_time = random.randint(min_sleep_time, max_sleep_time)  # Random sleep within the user-provided range
@@ -198,4 +282,5 @@ if __name__ == "__main__":
             # Countdown timer for next scrape
             countdown(sleep_time)
 
-        print("Initial scraping completed for all accounts.")
\ No newline at end of file
+        print("Initial scraping completed for all accounts.")
+        print_run_summary(run_summary)
\ No newline at end of file
@@ -0,0 +1,171 @@
+import os
+import json
+import lzma
+import sqlite3
+import logging
+import argparse
+from datetime import datetime
+
+import instaloader
+
+from layout import DATE_PREFIX, shard_dir
+
+# 'files' lets Instaloader write its .json.xz and .txt sidecar files next to the media;
+# 'packed' keeps the metadata of all posts of a user in one compressed, indexed SQLite file instead
+METADATA_STORE = os.environ.get('METADATA_STORE', 'files')
+PACKED_METADATA = METADATA_STORE == 'packed'
+
+# Store file in downloads/{username}/
+STORE_NAME = 'metadata.sqlite'
+
+# Instaloader options that turn off the sidecar files when the metadata is packed
+INSTALOADER_OPTIONS = {'save_metadata': False, 'post_metadata_txt_pattern': ''} if PACKED_METADATA else {}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+    shortcode TEXT PRIMARY KEY,
+    media_dir TEXT NOT NULL,   -- Unsharded directory of the post's media
+    prefix TEXT NOT NULL,      -- Filename prefix of the post's files
+    date_utc TEXT,
+    typename TEXT,
+    caption TEXT,
+    metadata BLOB NOT NULL     -- LZMA-compressed Instaloader JSON structure
+);
+CREATE INDEX IF NOT EXISTS posts_date ON posts (date_utc);
+'''
+
+_connections = {}  # Open stores by path, reused across posts
+
+def open_store(base_dir):
+    """Open (and create if needed) the metadata store of a user directory."""
+    path = os.path.join(base_dir, STORE_NAME)
+    if path not in _connections:
+        conn = sqlite3.connect(path)
+        conn.executescript(SCHEMA)
+        _connections[path] = conn
+    return _connections[path]
+
+def put_post(conn, shortcode, media_dir, prefix, date_utc, typename, caption, structure):
+    """Insert or replace the metadata of one post (the caller commits)."""
+    blob = lzma.compress(json.dumps(structure, separators=(',', ':')).encode('utf-8'))
+    conn.execute('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                 (shortcode, media_dir, prefix, date_utc.strftime('%Y-%m-%d %H:%M:%S') if date_utc else None,
+                  typename, caption, blob))
+
+def store_post(L, post, base_dir, media_dir):
+    """Pack the metadata of a downloaded post into the user's store."""
+    conn = open_store(base_dir)
+    prefix = os.path.basename(L.format_filename(post, target=media_dir))
+    put_post(conn, post.shortcode, media_dir, prefix, post.date_utc, post.typename, post.caption,
+             instaloader.get_json_structure(post))
+    conn.commit()
+
+def read_post_metadata(base_dir, shortcode):
+    """Return the Instaloader JSON structure of a post by shortcode, or None if it is not stored."""
+    if not os.path.isfile(os.path.join(base_dir, STORE_NAME)):
+        return None
+    row = open_store(base_dir).execute('SELECT metadata FROM posts WHERE shortcode = ?', (shortcode,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(lzma.decompress(row[0]))
+
+def load_post(context, base_dir, shortcode):
+    """Return the stored post as an instaloader.Post, or None if it is not stored."""
+    structure = read_post_metadata(base_dir, shortcode)
+    return instaloader.load_structure(context, structure) if structure else None
+
+def iter_posts(base_dir):
+    """Yield (shortcode, media_dir, prefix, date_utc, caption, structure) of every stored post."""
+    rows = open_store(base_dir).execute(
+        'SELECT shortcode, media_dir, prefix, date_utc, caption, metadata FROM posts ORDER BY date_utc')
+    for shortcode, media_dir, prefix, date_text, caption, blob in rows:
+        date_utc = datetime.strptime(date_text, '%Y-%m-%d %H:%M:%S') if date_text else None
+        yield shortcode, media_dir, prefix, date_utc, caption, json.loads(lzma.decompress(blob))
+
+def export_user(base_dir):
+    """Write the stored metadata back as Instaloader's per-post .json.xz and .txt files."""
+    exported = 0
+    for shortcode, media_dir, prefix, date_utc, caption, structure in iter_posts(base_dir):
+        target_dir = shard_dir(media_dir, shortcode, date_utc)
+        os.makedirs(target_dir, exist_ok=True)
+        filename = os.path.join(target_dir, prefix)
+        # Same format as instaloader.save_structure_to_file with compression
+        with lzma.open(f"{filename}.json.xz", 'wt', check=lzma.CHECK_NONE) as f:
+            json.dump(structure, f, separators=(',', ':'))
+        if caption:
+            with open(f"{filename}.txt", 'w', encoding='utf-8') as f:
+                f.write(caption)
+        exported += 1
+    logging.info(f"Exported the metadata of {exported} posts in {base_dir}.")
+    return exported
+
+def pack_user(base_dir, remove=True):
+    """Move the existing .json.xz/.txt sidecar files of a user directory into its store."""
+    conn = open_store(base_dir)
+    packed = 0
+    for dirpath, dirnames, filenames in os.walk(base_dir):
+        names = set(filenames)
+        media_dir = dirpath
+        # Sidecars in a shard directory belong to the media directory above the shards
+        while os.path.basename(media_dir) not in ('images', 'videos') and media_dir != base_dir:
+            media_dir = os.path.dirname(media_dir)
+        for filename in filenames:
+            match = DATE_PREFIX.match(filename)
+            if not match or not filename.endswith('.json.xz'):
+                continue
+            prefix = filename[:-len('.json.xz')]
+            json_path = os.path.join(dirpath, filename)
+            txt_path = os.path.join(dirpath, f"{prefix}.txt")
+            try:
+                with lzma.open(json_path, 'rt', encoding='utf-8') as f:
+                    structure = json.load(f)
+                node = structure.get('node', {})
+                shortcode = node.get('shortcode') or node.get('code')
+                if not shortcode:
+                    logging.warning(f"No shortcode in {json_path}, leaving it in place.")
+                    continue
+                caption = None
+                if f"{prefix}.txt" in names:
+                    with open(txt_path, 'r', encoding='utf-8') as f:
+                        caption = f.read()
+                put_post(conn, shortcode, media_dir, prefix,
+                         datetime(*map(int, match.groups())), node.get('__typename'), caption, structure)
+            except Exception as e:
+                logging.warning(f"Could not pack {json_path}: {e}")
+                continue
+            conn.commit()
+            if remove:
+                os.remove(json_path)
+                if f"{prefix}.txt" in names:
+                    os.remove(txt_path)
+            packed += 1
+    logging.info(f"Packed the metadata of {packed} posts in {base_dir}.")
+    return packed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Packed per-user store of post metadata.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('pack', "Move existing sidecar files into the store"),
+                            ('export', "Write the store back as per-post sidecar files")):
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument('usernames', nargs='*', help="Usernames to process (default: all)")
+        subparser.add_argument('--root', default='downloads', help="Downloads root holding one directory per username")
+    get_parser = subparsers.add_parser('get', help="Print the stored metadata of a post")
+    get_parser.add_argument('username')
+    get_parser.add_argument('shortcode')
+    get_parser.add_argument('--root', default='downloads', help="Downloads root holding one directory per username")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'get':
+        structure = read_post_metadata(os.path.join(args.root, args.username), args.shortcode)
+        print(json.dumps(structure, indent=2) if structure else f"{args.shortcode} is not stored.")
+    else:
+        usernames = args.usernames or sorted(d for d in os.listdir(args.root) if os.path.isdir(os.path.join(args.root, d)))
+        for username in usernames:
+            base_dir = os.path.join(args.root, username)
+            if args.command == 'pack':
+                pack_user(base_dir)
+            else:
+                export_user(base_dir)
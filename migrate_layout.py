@@ -0,0 +1,240 @@
+import os
+import csv
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from caption_index import read_sidecar
+from integrity import INTEGRITY_MANIFEST
+from layout import DATE_PREFIX, LAYOUTS, LAYOUT, shard_dir
+from metadata_store import STORE_NAME, iter_posts
+
+# Subdirectories of downloads/{username} that hold media of their own
+MEDIA_SUBDIRS = ('images', 'videos')
+
+JOURNAL_NAME = '.layout_journal.csv'
+
+def read_log_shortcodes(log_paths):
+    """Map every file path recorded in the download logs to its shortcode."""
+    shortcodes = {}
+    for log_path in log_paths:
+        if not os.path.isfile(log_path):
+            logging.warning(f"Log file does not exist: {log_path}")
+            continue
+        with open(log_path, 'r', newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)  # Skip the header
+            for row in reader:
+                if len(row) >= 3:
+                    shortcodes[os.path.normpath(row[2])] = row[1]
+    logging.debug(f"Loaded {len(shortcodes)} file paths from the download logs.")
+    return shortcodes
+
+def media_dirs(root):
+    """Yield every media directory below the downloads root."""
+    for username in sorted(os.listdir(root)):
+        base_dir = os.path.join(root, username)
+        if not os.path.isdir(base_dir):
+            continue
+        yield base_dir, MEDIA_SUBDIRS
+        for subdir in MEDIA_SUBDIRS:
+            media_dir = os.path.join(base_dir, subdir)
+            if os.path.isdir(media_dir):
+                yield media_dir, ()
+
+def media_files(media_dir, excluded):
+    """Yield the files below a media directory, skipping the excluded top-level subdirectories."""
+    for dirpath, dirnames, filenames in os.walk(media_dir):
+        if dirpath == media_dir:
+            dirnames[:] = [d for d in dirnames if d not in excluded]
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+def post_date(path):
+    """Return the UTC post date of a file from its name, falling back to its modification time."""
+    match = DATE_PREFIX.match(os.path.basename(path))
+    if match:
+        return datetime(*map(int, match.groups()))
+    # Instaloader sets the mtime to the post date, the other writers to the download time
+    return datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc).replace(tzinfo=None)
+
+def sidecar_shortcodes(shortcodes):
+    """Map (directory, date prefix) of every logged Instaloader file to its shortcode.
+
+    Sidecar files of a post (.json.xz, .txt, ...) share the prefix and directory
+    of its media but may not be logged themselves.
+    """
+    prefixes = {}
+    for path, shortcode in shortcodes.items():
+        match = DATE_PREFIX.match(os.path.basename(path))
+        if match:
+            prefixes[(os.path.dirname(path), match.group(0))] = shortcode
+    return prefixes
+
+def metadata_shortcodes(root):
+    """Map (directory, date prefix) of every post with metadata on disk to its shortcode.
+
+    Most files downloaded before the logs matched Instaloader's filenames were
+    never logged, but their shortcode is in the post's .json.xz/.json sidecar
+    (keyed by the sidecar's directory) or in the user's packed metadata store
+    (keyed by the post's media directory).
+    """
+    prefixes = {}
+    for username in sorted(os.listdir(root)):
+        base_dir = os.path.join(root, username)
+        if not os.path.isdir(base_dir):
+            continue
+        if os.path.isfile(os.path.join(base_dir, STORE_NAME)):
+            for shortcode, media_dir, prefix, date_utc, caption, structure in iter_posts(base_dir):
+                prefixes[(os.path.normpath(media_dir), prefix)] = shortcode
+        for dirpath, dirnames, filenames in os.walk(base_dir):
+            for filename in filenames:
+                match = DATE_PREFIX.match(filename)
+                if not match or not (filename.endswith('.json.xz') or filename.endswith('.json')):
+                    continue
+                try:
+                    shortcode, caption = read_sidecar(os.path.join(dirpath, filename))
+                except Exception as e:
+                    logging.warning(f"Could not read metadata of {filename}: {e}")
+                    continue
+                if shortcode:
+                    prefixes[(os.path.normpath(dirpath), match.group(0))] = shortcode
+    logging.debug(f"Found the shortcodes of {len(prefixes)} posts in their metadata.")
+    return prefixes
+
+def plan_move(path, media_dir, layout, shortcodes, prefixes):
+    """Return where a file belongs in the new layout, or None if it cannot be placed."""
+    shortcode = shortcodes.get(os.path.normpath(path))
+    match = DATE_PREFIX.match(os.path.basename(path))
+    if shortcode is None and match:
+        shortcode = prefixes.get((os.path.dirname(os.path.normpath(path)), match.group(0)))
+        if shortcode is None:
+            # Posts in a packed metadata store are keyed by their unsharded media directory
+            shortcode = prefixes.get((os.path.normpath(media_dir), match.group(0)))
+    if shortcode is None and not match:
+        return None  # Not a downloaded post file (or never logged), leave it alone
+    if layout == 'shortcode' and shortcode is None:
+        return None  # Neither logged nor described by metadata on disk, and the name has no shortcode
+    target_dir = shard_dir(media_dir, shortcode or '', post_date(path), layout=layout)
+    return os.path.join(target_dir, os.path.basename(path))
+
+class Journal:
+    """Append-only record of the moves done so far, so an interrupted migration can be resumed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, old_path, new_path):
+        with self.lock:
+            with open(self.path, 'a', newline='') as f:
+                csv.writer(f).writerow([old_path, new_path])
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self):
+        """Return the old -> new mapping of every journaled move."""
+        moves = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', newline='') as f:
+                for row in csv.reader(f):
+                    if len(row) == 2:
+                        moves[os.path.normpath(row[0])] = row[1]
+        return moves
+
+def move_file(old_path, new_path, journal):
+    """Move one file into its shard directory. Returns True if it was moved."""
+    if os.path.exists(new_path):
+        logging.warning(f"Not moving {old_path}: {new_path} already exists.")
+        return False
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    os.rename(old_path, new_path)
+    journal.record(old_path, new_path)
+    return True
+
+def resolve(path, moves):
+    """Follow the journaled moves of a path to its final location."""
+    path = os.path.normpath(path)
+    seen = set()
+    while path in moves and path not in seen:
+        seen.add(path)
+        path = os.path.normpath(moves[path])
+    return path
+
+def rewrite_log(log_path, moves):
+    """Rewrite the file paths of a download log according to the journaled moves."""
+    if not os.path.isfile(log_path):
+        return 0
+    with open(log_path, 'r', newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    changed = 0
+    for row in rows[1:]:
+        if len(row) >= 3:
+            new_path = resolve(row[2], moves)
+            if new_path != os.path.normpath(row[2]):
+                row[2] = new_path
+                changed += 1
+    if changed:
+        tmp_path = f"{log_path}.tmp"
+        with open(tmp_path, 'w', newline='') as csvfile:
+            csv.writer(csvfile).writerows(rows)
+        os.replace(tmp_path, log_path)
+    logging.info(f"Updated {changed} paths in {log_path}.")
+    return changed
+
+def migrate(root, layout, log_paths, workers):
+    """Move every downloaded file below `root` into `layout` and update the download logs."""
+    shortcodes = read_log_shortcodes(log_paths)
+    # Moves of an interrupted run count as logged too
+    journal = Journal(os.path.join(root, JOURNAL_NAME))
+    for old_path, new_path in journal.read().items():
+        if old_path in shortcodes:
+            shortcodes[os.path.normpath(new_path)] = shortcodes[old_path]
+
+    # Logged files take precedence over the metadata on disk
+    prefixes = metadata_shortcodes(root)
+    prefixes.update(sidecar_shortcodes(shortcodes))
+
+    plan, skipped = [], 0
+    for media_dir, excluded in media_dirs(root):
+        for path in media_files(media_dir, excluded):
+            new_path = plan_move(path, media_dir, layout, shortcodes, prefixes)
+            if new_path is None:
+                skipped += 1
+            elif os.path.normpath(new_path) != os.path.normpath(path):
+                plan.append((path, new_path))
+    logging.info(f"{len(plan)} files to move, {skipped} files left in place.")
+
+    moved = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for done in executor.map(lambda move: move_file(move[0], move[1], journal), plan):
+            moved += done
+    print(f"Moved {moved} of {len(plan)} files into the '{layout}' layout ({skipped} files left in place).")
+
+    # Apply every journaled move, including those of earlier interrupted runs, to the logs
+    moves = journal.read()
+    for log_path in log_paths:
+        rewrite_log(log_path, moves)
+    if os.path.isfile(journal.path):
+        os.remove(journal.path)
+
+    # Drop the shard directories emptied by the move
+    for media_dir, excluded in media_dirs(root):
+        for dirpath, dirnames, filenames in os.walk(media_dir, topdown=False):
+            if dirpath != media_dir and os.path.basename(dirpath) not in excluded and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert existing download trees to another directory layout in place.")
+    parser.add_argument('--root', default='downloads', help="Downloads root holding one directory per username")
+    parser.add_argument('--layout', default=LAYOUT, choices=LAYOUTS, help="Layout to convert to (default: DOWNLOAD_LAYOUT)")
+    parser.add_argument('--log', action='append', default=[], help="Download log CSV (or integrity manifest) to update (repeatable)")
+    parser.add_argument('--workers', type=int, default=8, help="Number of files moved in parallel")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    log_paths = args.log or ['instagram_downloads_log.csv', 'download_log.csv', INTEGRITY_MANIFEST]
+    migrate(args.root, args.layout, log_paths, args.workers)
@@ -0,0 +1,194 @@
+import os
+import csv
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Name suffix of the images stored in preview mode (see preview.py)
+PREVIEW_SUFFIX = '_preview'
+
+# Largest Hamming distance (out of 64 bits) at which two images count as the same photo
+DEFAULT_THRESHOLD = 6
+
+# Number of hashes compared against each other at once (BLOCK x BLOCK distances in memory)
+BLOCK = 2048
+
+def image_hashes(path):
+    """Return the (aHash, dHash) of an image as two 64-bit integers, or None if it cannot be read."""
+    try:
+        with Image.open(path) as img:
+            img.draft('L', (64, 64))  # Let the JPEG decoder downscale while decoding
+            gray = img.convert('L')
+            small = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    except Exception as e:
+        logging.warning(f"Could not hash {path}: {e}")
+        return None
+    # aHash: each of the left 8x8 pixels against their mean; dHash: each pixel against its right neighbour
+    ahash = small[:, :8] > small[:, :8].mean()
+    dhash = small[:, 1:] > small[:, :-1]
+    return (int.from_bytes(np.packbits(ahash).tobytes(), 'big'),
+            int.from_bytes(np.packbits(dhash).tobytes(), 'big'))
+
+def find_images(root):
+    """Yield every image file below the downloads root, except the previews of preview mode."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            stem, extension = os.path.splitext(filename)
+            # A preview and the full image hydrated next to it would always show up as a cluster
+            if extension.lower() in IMAGE_EXTENSIONS and not stem.endswith(PREVIEW_SUFFIX):
+                yield os.path.join(dirpath, filename)
+
+def load_index(index_path):
+    """Load the index as a dict of arrays (empty arrays if it does not exist yet)."""
+    if os.path.isfile(index_path):
+        with np.load(index_path) as data:
+            return {name: data[name] for name in data.files}
+    return {
+        'paths': np.array([], dtype=str),
+        'sizes': np.array([], dtype=np.int64),
+        'mtimes': np.array([], dtype=np.float64),
+        'ahash': np.array([], dtype=np.uint64),
+        'dhash': np.array([], dtype=np.uint64),
+    }
+
+def save_index(index_path, index):
+    """Write the index atomically."""
+    tmp_path = f"{index_path}.tmp.npz"
+    np.savez(tmp_path, **index)
+    os.replace(tmp_path, index_path)
+
+def update_index(root, index_path, workers=None):
+    """Hash the images that are new or changed since the last update and drop the deleted ones."""
+    index = load_index(index_path)
+    known = {path: i for i, path in enumerate(index['paths'].tolist())}
+
+    keep, todo = [], []
+    for path in find_images(root):
+        stat = os.stat(path)
+        i = known.get(path)
+        if i is not None and index['sizes'][i] == stat.st_size and index['mtimes'][i] == stat.st_mtime:
+            keep.append(i)
+        else:
+            todo.append((path, stat.st_size, stat.st_mtime))
+    logging.info(f"{len(keep)} images unchanged, {len(todo)} new or changed, "
+                 f"{len(known) - len(keep)} removed or changed.")
+
+    # Decoding dominates, so hash in parallel processes
+    new = {'paths': [], 'sizes': [], 'mtimes': [], 'ahash': [], 'dhash': []}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(image_hashes, [path for path, _, _ in todo], chunksize=64)
+        for (path, size, mtime), hashes in zip(todo, results):
+            if hashes is None:
+                continue
+            new['paths'].append(path)
+            new['sizes'].append(size)
+            new['mtimes'].append(mtime)
+            new['ahash'].append(hashes[0])
+            new['dhash'].append(hashes[1])
+
+    keep = np.array(keep, dtype=np.int64)
+    index = {
+        'paths': np.concatenate([index['paths'][keep], np.array(new['paths'], dtype=str)]),
+        'sizes': np.concatenate([index['sizes'][keep], np.array(new['sizes'], dtype=np.int64)]),
+        'mtimes': np.concatenate([index['mtimes'][keep], np.array(new['mtimes'], dtype=np.float64)]),
+        'ahash': np.concatenate([index['ahash'][keep], np.array(new['ahash'], dtype=np.uint64)]),
+        'dhash': np.concatenate([index['dhash'][keep], np.array(new['dhash'], dtype=np.uint64)]),
+    }
+    save_index(index_path, index)
+    print(f"Index holds {len(index['paths'])} images ({len(new['paths'])} hashed in this update).")
+    return index
+
+def find_pairs(ahash, dhash, threshold, block=BLOCK):
+    """Return the index pairs (i < j) whose aHash and dHash both differ in at most `threshold` bits.
+
+    Hashes are compared block against block with vectorized XOR and popcount.
+    Since two hashes cannot differ in fewer bits than their popcounts do, the
+    hashes are sorted by dHash popcount and each block is only compared with
+    the blocks whose popcounts are within `threshold` of its own.
+    """
+    weights = np.bitwise_count(dhash).astype(np.int16)
+    order = np.argsort(weights, kind='stable')
+    ahash, dhash, weights = ahash[order], dhash[order], weights[order]
+    n = len(dhash)
+
+    pairs = []
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        # Later columns only, up to the last hash whose popcount is still within reach
+        col_stop = np.searchsorted(weights, weights[stop - 1] + threshold, side='right')
+        for col in range(start, col_stop, block):
+            col_end = min(col + block, col_stop)
+            dist = np.bitwise_count(dhash[start:stop, None] ^ dhash[None, col:col_end])
+            rows, cols = np.nonzero(dist <= threshold)
+            rows += start
+            cols += col
+            upper = rows < cols
+            rows, cols = rows[upper], cols[upper]
+            close = np.bitwise_count(ahash[rows] ^ ahash[cols]) <= threshold
+            pairs.append(np.stack([order[rows[close]], order[cols[close]]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.concatenate(pairs)
+
+def cluster_pairs(pairs, n):
+    """Group the matched pairs into clusters with union-find; returns lists of indices."""
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_j] = root_i
+
+    clusters = {}
+    for i in np.unique(pairs):
+        clusters.setdefault(find(i), []).append(i)
+    return sorted(clusters.values(), key=len, reverse=True)
+
+def report(index, threshold, output=None):
+    """Print (or write to a CSV file) the clusters of near-duplicate images."""
+    pairs = find_pairs(index['ahash'], index['dhash'], threshold)
+    clusters = cluster_pairs(pairs, len(index['paths']))
+    print(f"Found {len(clusters)} clusters of near-duplicates ({len(pairs)} matching pairs) "
+          f"among {len(index['paths'])} images.")
+    if output:
+        with open(output, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["Cluster", "File Path", "Size"])
+            for number, cluster in enumerate(clusters, 1):
+                for i in cluster:
+                    writer.writerow([number, index['paths'][i], index['sizes'][i]])
+        print(f"Clusters written to {output}")
+    else:
+        for number, cluster in enumerate(clusters, 1):
+            print(f"Cluster {number}:")
+            for i in cluster:
+                print(f"  {index['paths'][i]}")
+    return clusters
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate images across the downloads with perceptual hashes.")
+    parser.add_argument('command', choices=['update', 'report'], help="'update' the index, or 'report' duplicate clusters")
+    parser.add_argument('--root', default='downloads', help="Downloads root to index")
+    parser.add_argument('--index', default='phash_index.npz', help="Index file")
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD, help="Maximum Hamming distance in bits")
+    parser.add_argument('--output', help="Write the clusters to this CSV file instead of printing them")
+    parser.add_argument('--workers', type=int, help="Number of hashing processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'update':
+        update_index(args.root, args.index, args.workers)
+    else:
+        report(load_index(args.index), args.threshold, args.output)
@@ -1,13 +1,35 @@
 import os
 import csv
+import json
 import time
 import logging
 import requests
+from datetime import datetime
 from playwright.sync_api import sync_playwright
 
+from caption_index import index_post
+from layout import shard_dir
+from preview import PREVIEW_MANIFEST, PREVIEW_MODE, PREVIEW_SUFFIX, record_preview, smallest_rendition
+from response_cache import ResponseCache
+
 # Initialize logging for debugging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Read post data from the JSON responses the profile page receives while scrolling,
+# navigating to the individual post pages only for posts missing from them
+CAPTURE_RESPONSES = True
+
+# Response cache for the browser: 'off', 'record' (serve from disk, fetch and store misses;
+# pages and API responses are fetched again after CACHE_MAX_AGE so new posts show up)
+# or 'replay' (serve from disk only, never touch the network, media downloads are skipped)
+CACHE_MODE = os.environ.get('PLAYWRIGHT_CACHE', 'off')
+CACHE_DIR = 'playwright_cache'
+CACHE_MAX_BYTES = 500 * 1024 * 1024
+CACHE_MAX_AGE = 15 * 60  # In seconds
+
+# Keys holding the children of carousel posts, which are not posts of their own
+CAROUSEL_KEYS = ('carousel_media', 'edge_sidecar_to_children')
+
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/85.0.4183.121 Safari/537.36',
 }
@@ -69,6 +91,79 @@ def extract_video_url_from_page(page):
         logging.error(f"Error extracting video URL: {e}")
         return None
 
+def extract_thumbnail_url_from_page(page):
+    """Return the thumbnail URL of the current post page, or None if the page has none."""
+    try:
+        # Short timeout: pages without og:image should not wait for the default 30 seconds
+        return page.locator("meta[property='og:image']").first.get_attribute('content', timeout=2000)
+    except Exception as e:
+        logging.debug(f"No thumbnail found on the post page: {e}")
+        return None
+
+def extract_posts_from_json(data, posts):
+    """Collect the post nodes found anywhere in a JSON document into `posts` (keyed by shortcode).
+
+    Handles both the GraphQL nodes (shortcode, is_video, video_url, taken_at_timestamp)
+    and the API v1 items (code, media_type, video_versions, taken_at).
+    """
+    if isinstance(data, dict):
+        shortcode = data.get('shortcode') or data.get('code')
+        if isinstance(shortcode, str) and ('is_video' in data or 'media_type' in data):
+            video_url = data.get('video_url')
+            if not video_url and data.get('video_versions'):
+                video_url = data['video_versions'][0].get('url')  # The first version has the highest quality
+            post = posts.setdefault(shortcode, {})
+            post['is_video'] = data['is_video'] if 'is_video' in data else data.get('media_type') == 2
+            if video_url:
+                post['video_url'] = video_url
+            thumbnail_url = smallest_rendition(data) or data.get('thumbnail_src') or data.get('display_url')
+            if thumbnail_url:
+                post['thumbnail_url'] = thumbnail_url
+            taken_at = data.get('taken_at_timestamp') or data.get('taken_at')
+            if taken_at:
+                post['taken_at'] = taken_at
+            caption = data.get('caption')
+            if isinstance(caption, dict):
+                post['caption'] = caption.get('text')
+            elif data.get('edge_media_to_caption', {}).get('edges'):
+                post['caption'] = data['edge_media_to_caption']['edges'][0]['node']['text']
+            owner = data.get('owner') or data.get('user')
+            if isinstance(owner, dict) and owner.get('username'):
+                post['owner'] = owner['username']
+        for key, value in data.items():
+            if key not in CAROUSEL_KEYS:
+                extract_posts_from_json(value, posts)
+    elif isinstance(data, list):
+        for item in data:
+            extract_posts_from_json(item, posts)
+
+def capture_post_responses(page, posts):
+    """Parse the post nodes out of every GraphQL/API response the page receives."""
+    def handle_response(response):
+        if response.request.resource_type not in ('xhr', 'fetch'):
+            return
+        if '/graphql' not in response.url and '/api/v1/' not in response.url:
+            return
+        try:
+            data = response.json()
+        except Exception as e:
+            logging.debug(f"Could not parse response from {response.url}: {e}")
+            return
+        found = len(posts)
+        extract_posts_from_json(data, posts)
+        if len(posts) > found:
+            logging.debug(f"Captured {len(posts) - found} posts from {response.url}")
+
+    page.on("response", handle_response)
+
+def extract_embedded_posts(page, posts):
+    """Collect the post nodes embedded as JSON in the profile page itself (the first posts)."""
+    for text in page.locator('script[type="application/json"]').all_text_contents():
+        try:
+            extract_posts_from_json(json.loads(text), posts)
+        except ValueError:
+            continue
+
 def read_usernames_from_csv(file_path):
     """Read Instagram usernames from a CSV file."""
     usernames = []
@@ -90,9 +185,45 @@ def read_usernames_from_csv(file_path):
         print(f"Error reading CSV file: {e}")
     return usernames
 
-def download_user_videos(username, base_url="https://www.instagram.com"):
+def save_post_video(username, shortcode, video_url, base_dir, taken_at=None, thumbnail_url=None):
+    """Download one post's video (or only its thumbnail in preview mode) into its shard directory.
+
+    Returns the log row, or None if nothing was saved.
+    """
+    date_utc = datetime.utcfromtimestamp(taken_at) if taken_at else None
+    save_dir = shard_dir(base_dir, shortcode, date_utc)
+    if CACHE_MODE == 'replay':
+        logging.info(f"Replay mode: not downloading {shortcode} from {video_url}")
+        return None
+    create_directory(save_dir)
+    if PREVIEW_MODE:
+        if not thumbnail_url:
+            logging.error(f"No thumbnail found for {shortcode}, skipping its preview.")
+            return None
+        # Keep the thumbnail and remember the video URL for preview.py hydrate
+        file_path = download_video(thumbnail_url, save_dir, f"{shortcode}{PREVIEW_SUFFIX}.jpg")
+        if file_path:
+            date_text = date_utc.strftime('%Y-%m-%d %H:%M:%S') if date_utc else ''
+            record_preview(os.path.join(base_dir, PREVIEW_MANIFEST),
+                           [shortcode, 'playwright', 'GraphVideo', base_dir, date_text, file_path,
+                            json.dumps([video_url]), time.strftime('%Y-%m-%d %H:%M:%S')])
+    else:
+        # Use the shortcode as filename
+        file_path = download_video(video_url, save_dir, f"{shortcode}.mp4")
+    if not file_path:
+        return None
+    if taken_at:
+        os.utime(file_path, (taken_at, taken_at))  # Like Instaloader, date the file by the post
+    return [username, shortcode, file_path, time.strftime('%Y-%m-%d %H:%M:%S')]
+
+def download_user_videos(username, base_url="https://www.instagram.com", capture_responses=CAPTURE_RESPONSES):
     """Download all videos from the given Instagram username using Playwright without login."""
     logs = []
+    posts = {}  # Post data captured from the page's JSON responses, keyed by shortcode
+    cache = None
+    if CACHE_MODE != 'off':
+        cache = ResponseCache(CACHE_DIR, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE,
+                              replay=CACHE_MODE == 'replay')
     try:
         # Create a directory for the user to save videos
         base_dir = f"downloads/{username}"
@@ -103,7 +234,11 @@ def download_user_videos(username, base_url="https://www.instagram.com"):
             logging.debug(f"Launching browser for {username}...")
             browser = p.chromium.launch(headless=False)  # Change to headless=True if you want it to run headless
             context = browser.new_context()
+            if cache:
+                cache.attach(context)
             page = context.new_page()
+            if capture_responses:
+                capture_post_responses(page, posts)
 
             # Navigate to the user's profile page
             profile_url = f"{base_url}/{username}/"
@@ -116,6 +251,9 @@ def download_user_videos(username, base_url="https://www.instagram.com"):
                 logging.error(f"Profile page requires login for {username}. Skipping this user.")
                 return []  # Skip this user if login is required
 
+            if capture_responses:
+                extract_embedded_posts(page, posts)
+
             # Scroll to load more posts (simulate user scroll)
             logging.debug(f"Scrolling to load more posts for {username}...")
             for _ in range(5):  # Adjust range for more/less posts
@@ -125,30 +263,56 @@ def download_user_videos(username, base_url="https://www.instagram.com"):
             # Find all post links on the page
             logging.debug("Extracting post links from the profile page...")
             post_links = page.locator('a[href*="/p/"]').evaluate_all('elements => elements.map(e => e.href)')
-            logging.debug(f"Found {len(post_links)} post links for user {username}.")
+            logging.debug(f"Found {len(post_links)} post links and {len(posts)} captured posts for user {username}.")
 
-            # Iterate over each post link and download video if available
+            # Videos known from the captured responses are downloaded directly
+            navigated = 0
+            for shortcode, post in posts.items():
+                if post.get('owner', username) != username:
+                    continue  # Posts of other accounts shown on the page
+                if post.get('video_url'):
+                    log = save_post_video(username, shortcode, post['video_url'], base_dir,
+                                          post.get('taken_at'), post.get('thumbnail_url'))
+                    if log:
+                        logs.append(log)
+                        taken_at = post.get('taken_at')
+                        date_utc = datetime.utcfromtimestamp(taken_at) if taken_at else None
+                        index_post(username, shortcode, date_utc, post.get('caption'))
+
+            # Fall back to visiting the post page for posts the responses said nothing about
             for post_url in post_links:
+                shortcode = post_url.split('/')[-2]
+                post = posts.get(shortcode)
+                if post and (post.get('video_url') or not post['is_video']):
+                    continue
+
                 logging.debug(f"Visiting post URL: {post_url}")
                 page.goto(post_url)
                 page.wait_for_timeout(3000)
+                navigated += 1
 
                 video_url = extract_video_url_from_page(page)
                 if video_url:
-                    # Use the shortcode from the URL as filename
-                    shortcode = post_url.split('/')[-2]
-                    filename = f"{shortcode}.mp4"
-                    file_path = download_video(video_url, base_dir, filename)
-                    if file_path:
-                        logs.append([username, shortcode, file_path, time.strftime('%Y-%m-%d %H:%M:%S')])
+                    thumbnail_url = extract_thumbnail_url_from_page(page) if PREVIEW_MODE else None
+                    taken_at = post.get('taken_at') if post else None
+                    log = save_post_video(username, shortcode, video_url, base_dir, taken_at, thumbnail_url)
+                    if log:
+                        logs.append(log)
+                        # Whatever the responses told about the post; without them the post still gets a row
+                        date_utc = datetime.utcfromtimestamp(taken_at) if taken_at else None
+                        index_post(username, shortcode, date_utc, post.get('caption') if post else None)
 
             # Close the browser
             context.close()
             browser.close()
-            logging.debug(f"Finished downloading videos for {username}. Total files: {len(logs)}")
+            logging.debug(f"Finished downloading videos for {username}. Total files: {len(logs)}, "
+                          f"post pages visited: {navigated} of {len(post_links)}")
     except Exception as e:
         logging.error(f"Error downloading videos for {username}: {e}")
         return []
+    finally:
+        if cache:
+            cache.close()
 
     return logs  # Return the logs for this user to be written to the CSV file
 
@@ -0,0 +1,184 @@
+import os
+import csv
+import json
+import time
+import logging
+import calendar
+import argparse
+from datetime import datetime
+
+import instaloader
+import requests
+
+from layout import shard_dir
+from metadata_store import INSTALOADER_OPTIONS, PACKED_METADATA, store_post
+
+# 'full' downloads the original media; 'preview' only stores the smallest image rendition
+# (the thumbnail for videos) and records the original media URLs for a later hydrate
+DOWNLOAD_MODE = os.environ.get('DOWNLOAD_MODE', 'full')
+PREVIEW_MODE = DOWNLOAD_MODE == 'preview'
+
+# Name suffix of the stored preview images
+PREVIEW_SUFFIX = '_preview'
+
+# Per-user manifest of the posts stored as preview, in downloads/{username}/
+PREVIEW_MANIFEST = 'preview_manifest.csv'
+MANIFEST_HEADER = ["Shortcode", "Source", "Typename", "Media Dir", "Date", "Preview Path", "Media URLs", "Timestamp"]
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/85.0.4183.121 Safari/537.36',
+}
+
+def smallest_rendition(node):
+    """Return the URL of the smallest image rendition listed in a post node, or None."""
+    candidates = []
+    for resource in node.get('display_resources') or node.get('thumbnail_resources') or []:
+        candidates.append((resource.get('config_width', 0), resource.get('src')))
+    for candidate in (node.get('image_versions2') or {}).get('candidates', []):
+        candidates.append((candidate.get('width', 0), candidate.get('url')))
+    candidates = [candidate for candidate in candidates if candidate[1]]
+    return min(candidates)[1] if candidates else None
+
+def original_media_url(node, is_video):
+    """Return the full-resolution media URL listed in a post node, or None if the node has none."""
+    if is_video:
+        return node.get('video_url') or (node.get('video_versions') or [{}])[0].get('url')
+    return node.get('display_url') or ((node.get('image_versions2') or {}).get('candidates') or [{}])[0].get('url')
+
+def record_preview(manifest_path, row):
+    """Append one post to a preview manifest."""
+    file_exists = os.path.isfile(manifest_path)
+    with open(manifest_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if not file_exists:
+            writer.writerow(MANIFEST_HEADER)
+        writer.writerow(row)
+
+def download_preview(L, post, media_dir, target_dir, manifest_path):
+    """Store the smallest image rendition of an Instaloader post instead of its full media."""
+    # The post node as returned by the feed; Instaloader has no accessor for the renditions
+    node = instaloader.get_json_structure(post)['node']
+    preview_url = smallest_rendition(node) or post.url
+    prefix = os.path.basename(L.format_filename(post, target=target_dir))
+    L.download_pic(os.path.join(target_dir, f"{prefix}{PREVIEW_SUFFIX}"), preview_url, post.date_local)
+    preview_path = next((os.path.join(target_dir, file) for file in os.listdir(target_dir)
+                         if file.startswith(f"{prefix}{PREVIEW_SUFFIX}")), None)
+
+    # Read from the node: Post.video_url fetches the full metadata of feed nodes without one.
+    # Without a URL, hydrate looks the post up again by shortcode
+    media_url = original_media_url(node, post.is_video)
+    media_urls = [media_url] if media_url else []
+    record_preview(manifest_path, [post.shortcode, 'instaloader', post.typename, media_dir,
+                                   post.date_utc.strftime('%Y-%m-%d %H:%M:%S'), preview_path,
+                                   json.dumps(media_urls), time.strftime('%Y-%m-%d %H:%M:%S')])
+    logging.debug(f"Stored preview of {post.shortcode}: {preview_path}")
+
+def read_manifests(root):
+    """Return the latest manifest row of every previewed post below the downloads root, by shortcode."""
+    entries = {}
+    for username in sorted(os.listdir(root)):
+        manifest_path = os.path.join(root, username, PREVIEW_MANIFEST)
+        if not os.path.isfile(manifest_path):
+            continue
+        with open(manifest_path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                row['Username'] = username
+                entries[row['Shortcode']] = row
+    return entries
+
+def fetch_url(url, file_path):
+    """Download a URL to a file; returns False if the (possibly expired) URL no longer works."""
+    try:
+        response = requests.get(url, headers=HEADERS, stream=True, timeout=60)
+        if response.status_code != 200:
+            logging.debug(f"Fetching {url} failed with status {response.status_code}")
+            return False
+        with open(f"{file_path}.temp", 'wb') as f:
+            for chunk in response.iter_content(chunk_size=8192):
+                f.write(chunk)
+        os.replace(f"{file_path}.temp", file_path)
+        return True
+    except Exception as e:
+        logging.debug(f"Fetching {url} failed: {e}")
+        return False
+
+def hydrate_post(L, entry, base_dir):
+    """Fetch the full-resolution media of one previewed post. Returns the paths written."""
+    shortcode = entry['Shortcode']
+    date_utc = datetime.strptime(entry['Date'], '%Y-%m-%d %H:%M:%S') if entry['Date'] else None
+    if entry['Preview Path'] and os.path.isfile(entry['Preview Path']):
+        target_dir = os.path.dirname(entry['Preview Path'])  # Next to the preview
+    else:
+        target_dir = shard_dir(entry['Media Dir'], shortcode, date_utc)
+    os.makedirs(target_dir, exist_ok=True)
+    media_urls = json.loads(entry['Media URLs'] or '[]')
+    is_video = entry['Typename'] == 'GraphVideo'
+
+    if entry['Source'] == 'playwright':
+        file_path = os.path.join(target_dir, f"{shortcode}.mp4")
+        if media_urls and fetch_url(media_urls[0], file_path):
+            return [file_path]
+        logging.error(f"Video URL of {shortcode} has expired; run playwr.py again to get a fresh one.")
+        return []
+
+    # Single media posts are tried with the recorded URL first, which costs no Instagram request
+    if entry['Typename'] in ('GraphImage', 'GraphVideo') and media_urls and date_utc:
+        post_prefix = f"{date_utc:%Y-%m-%d_%H-%M-%S}_UTC"
+        file_path = os.path.join(target_dir, f"{post_prefix}.{'mp4' if is_video else 'jpg'}")
+        if fetch_url(media_urls[0], file_path):
+            mtime = calendar.timegm(date_utc.timetuple())
+            os.utime(file_path, (mtime, mtime))  # Like Instaloader, date the file by the post
+            return [file_path]
+
+    # Expired URL or carousel post: fetch the post again
+    post = instaloader.Post.from_shortcode(L.context, shortcode)
+    before = set(os.listdir(target_dir))
+    L.download_post(post, target=target_dir)
+    if PACKED_METADATA:
+        store_post(L, post, base_dir, entry['Media Dir'])
+    return [os.path.join(target_dir, file) for file in sorted(set(os.listdir(target_dir)) - before)]
+
+def hydrate(shortcodes, root, log_file_path):
+    """Fetch the full-resolution media of the selected previewed posts and log them."""
+    entries = read_manifests(root)
+    L = instaloader.Instaloader(**INSTALOADER_OPTIONS)
+    hydrated = 0
+    for shortcode in shortcodes:
+        entry = entries.get(shortcode)
+        if entry is None:
+            logging.error(f"No preview recorded for {shortcode}.")
+            continue
+        try:
+            file_paths = hydrate_post(L, entry, os.path.join(root, entry['Username']))
+        except Exception as e:
+            logging.error(f"Error hydrating {shortcode}: {e}")
+            continue
+        if file_paths:
+            hydrated += 1
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+            file_exists = os.path.isfile(log_file_path)
+            with open(log_file_path, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if not file_exists:
+                    writer.writerow(["Username", "Shortcode", "File Path", "Timestamp"])
+                for file_path in file_paths:
+                    writer.writerow([entry['Username'], shortcode, file_path, timestamp])
+            logging.info(f"Hydrated {shortcode}: {', '.join(file_paths)}")
+    print(f"Hydrated {hydrated} of {len(shortcodes)} posts.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch full-resolution media for posts downloaded in preview mode.")
+    parser.add_argument('command', choices=['hydrate'], help="'hydrate' the given shortcodes")
+    parser.add_argument('shortcodes', nargs='*', help="Shortcodes of the posts to hydrate")
+    parser.add_argument('--file', help="File with one shortcode per line")
+    parser.add_argument('--root', default='downloads', help="Downloads root holding one directory per username")
+    parser.add_argument('--log', default='instagram_downloads_log.csv', help="CSV file the hydrated files are logged to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    shortcodes = list(args.shortcodes)
+    if args.file:
+        with open(args.file, 'r') as f:
+            shortcodes += [line.strip() for line in f if line.strip()]
+    hydrate(shortcodes, args.root, args.log)
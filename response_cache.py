@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from urllib.parse import parse_qs
+
+# Request headers that change what the server sends back and therefore belong in the cache key
+KEY_HEADERS = ('accept', 'accept-language', 'x-ig-app-id')
+
+# Fields of form-encoded GraphQL POST bodies that identify the query; the rest (__req, __spin_t,
+# __hsi, lsd, jazoest, ...) changes on every page load and would make every key unique
+QUERY_FORM_FIELDS = ('doc_id', 'query_hash', 'variables')
+
+# Resource types worth caching (pages, scripts and the JSON the page fetches); media is left alone
+CACHED_RESOURCE_TYPES = ('document', 'script', 'stylesheet', 'xhr', 'fetch')
+
+# Resource types whose content changes between runs (pages and API JSON); outside replay mode
+# they are only served from disk while younger than `max_age`
+FRESH_RESOURCE_TYPES = ('document', 'xhr', 'fetch')
+
+# Response headers that no longer apply once the decoded body is served from disk
+DROPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+class ResponseCache:
+    """On-disk cache of HTTP responses for Playwright browser contexts.
+
+    Responses are keyed by method, URL, request body (only QUERY_FORM_FIELDS of
+    GraphQL form posts) and KEY_HEADERS, stored as
+    one body file each plus a JSON index, and evicted least recently used first
+    once the cache grows beyond `max_bytes`. Pages and API responses older
+    than `max_age` seconds are fetched again. In replay mode every cached
+    response is served regardless of age and requests missing from the cache
+    are aborted instead of going to the network.
+    """
+
+    def __init__(self, cache_dir, max_bytes=500 * 1024 * 1024, max_age=15 * 60, replay=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.replay = replay
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.hits = self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.index = json.load(f)
+            except Exception as e:
+                logging.error(f"Error reading cache index, starting with an empty cache: {e}")
+        self.drop_orphans()
+        self.total_bytes = sum(entry['size'] for entry in self.index.values())
+
+    def drop_orphans(self):
+        """Reconcile the index with the body files on disk after a run that ended without close().
+
+        Bodies stored after the index was last saved have no entry to serve
+        them from, so they are deleted; entries whose body is gone are dropped.
+        """
+        bodies = {name[:-len('.body')] for name in os.listdir(self.cache_dir) if name.endswith('.body')}
+        orphans = bodies - set(self.index)
+        for key in orphans:
+            os.remove(self.body_path(key))
+        for key in set(self.index) - bodies:
+            del self.index[key]
+        if orphans:
+            logging.info(f"Removed {len(orphans)} cached responses missing from the cache index.")
+
+    def attach(self, context):
+        """Route every request of the browser context through the cache."""
+        context.route("**/*", self.handle_route)
+
+    def request_key(self, request):
+        """Return the cache key of a Playwright request."""
+        headers = request.headers
+        parts = [request.method, request.url, self.body_key(request)]
+        parts += [f"{name}:{headers.get(name, '')}" for name in KEY_HEADERS]
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def body_key(self, request):
+        """Return the part of the request body that identifies the response."""
+        body = request.post_data or ''
+        if 'application/x-www-form-urlencoded' in request.headers.get('content-type', ''):
+            fields = parse_qs(body, keep_blank_values=True)
+            if 'doc_id' in fields or 'query_hash' in fields:
+                return '&'.join(f"{name}={fields[name][0]}" for name in QUERY_FORM_FIELDS if name in fields)
+        return body
+
+    def body_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.body")
+
+    def handle_route(self, route):
+        """Serve a request from disk, or fetch and store it (aborting on a miss in replay mode)."""
+        request = route.request
+        if request.resource_type not in CACHED_RESOURCE_TYPES or request.method not in ('GET', 'POST'):
+            if self.replay:
+                route.abort()
+            else:
+                route.continue_()
+            return
+
+        key = self.request_key(request)
+        entry = self.index.get(key)
+        if entry and not self.replay and request.resource_type in FRESH_RESOURCE_TYPES \
+                and time.time() - entry.get('stored', 0) > self.max_age:
+            entry = None  # Stale page or API response, fetch it again
+        if entry and os.path.isfile(self.body_path(key)):
+            self.hits += 1
+            entry['last_used'] = time.time()
+            with open(self.body_path(key), 'rb') as f:
+                body = f.read()
+            route.fulfill(status=entry['status'], headers=entry['headers'], body=body)
+            return
+
+        self.misses += 1
+        if self.replay:
+            logging.warning(f"Replay mode: no cached response for {request.method} {request.url}")
+            route.abort()
+            return
+
+        try:
+            response = route.fetch()
+            body = response.body()
+        except Exception as e:
+            # Left unresolved, the request would stall the page until its navigation timeout
+            logging.warning(f"Fetching {request.method} {request.url} failed: {e}")
+            route.abort()
+            return
+        if response.status == 200:
+            headers = {name: value for name, value in response.headers.items() if name.lower() not in DROPPED_HEADERS}
+            self.store(key, request.url, response.status, headers, body)
+        route.fulfill(response=response, body=body)
+
+    def store(self, key, url, status, headers, body):
+        """Write a response to disk and evict old entries if the cache grew too large."""
+        with open(self.body_path(key), 'wb') as f:
+            f.write(body)
+        previous = self.index.get(key)
+        if previous:
+            self.total_bytes -= previous['size']
+        self.index[key] = {'url': url, 'status': status, 'headers': headers,
+                           'size': len(body), 'stored': time.time(), 'last_used': time.time()}
+        self.total_bytes += len(body)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is back to 90% of its limit."""
+        target = self.max_bytes * 0.9
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if self.total_bytes <= target:
+                break
+            self.total_bytes -= self.index.pop(key)['size']
+            try:
+                os.remove(self.body_path(key))
+            except FileNotFoundError:
+                pass
+        logging.debug(f"Cache evicted down to {self.total_bytes} bytes.")
+
+    def save_index(self):
+        """Write the index atomically."""
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        """Persist the index (including the access times of cache hits)."""
+        self.save_index()
+        logging.debug(f"Response cache: {self.hits} hits, {self.misses} misses, {self.total_bytes} bytes on disk.")
@@ -3,6 +3,9 @@ import instaloader
 import os
 from pathlib import Path
 
+from caption_index import index_post
+from layout import shard_dir
+
 # Debugging helper function
 def debug(message):
     print(f"[DEBUG] {message}")
@@ -50,16 +53,19 @@ def download_instagram_post(url, username, password, session_cookie, instagram_f
         post_shortcode = url.split("/")[-2]
         post = instaloader.Post.from_shortcode(L.context, post_shortcode)
         image_path, video_path, caption = None, None, None
+        target_folder = shard_dir(instagram_folder, post_shortcode, post.date_utc)
+        Path(target_folder).mkdir(parents=True, exist_ok=True)
 
         if post.is_video:
-            video_path = os.path.join(instagram_folder, f"{post_shortcode}.mp4")
-            L.download_post(post, target=instagram_folder)
+            video_path = os.path.join(target_folder, f"{post_shortcode}.mp4")
+            L.download_post(post, target=target_folder)
             debug(f"Video downloaded: {video_path}")
         else:
-            image_path = os.path.join(instagram_folder, f"{post_shortcode}.jpg")
-            L.download_post(post, target=instagram_folder)
+            image_path = os.path.join(target_folder, f"{post_shortcode}.jpg")
+            L.download_post(post, target=target_folder)
             debug(f"Image downloaded: {image_path}")
         
+        index_post(post.owner_username, post_shortcode, post.date_utc, post.caption)
         caption = post.caption if post.caption else "No caption"
         debug(f"Caption: {caption}")
 
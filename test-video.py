@@ -7,20 +7,40 @@ import random
 import sys
 import signal
 
+from caption_index import index_post
+from download_stats import new_run_summary, post_files, print_run_summary, update_run_summary
+from integrity import record_files, repair_broken_files
+from layout import shard_dir
+from metadata_store import INSTALOADER_OPTIONS, PACKED_METADATA, store_post
+from preview import PREVIEW_MANIFEST, PREVIEW_MODE, download_preview
+
 # Initialize logging for debugging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Initialize Instaloader instance
-L = instaloader.Instaloader()
+L = instaloader.Instaloader(**INSTALOADER_OPTIONS)
+
+# Handle graceful shutdowns: the first Ctrl-C lets the current post finish, the second aborts
+shutdown_requested = False
 
-# Handle graceful shutdowns
 def signal_handler(sig, frame):
-    logging.info("Script terminated by user.")
-    print("\nExiting gracefully...")
-    sys.exit(0)
+    global shutdown_requested
+    if shutdown_requested:
+        logging.info("Script aborted by user.")
+        print("\nAborting...")
+        sys.exit(1)
+    shutdown_requested = True
+    logging.info("Shutdown requested by user.")
+    print("\nFinishing the current post before exiting (press Ctrl-C again to abort)...")
 
 signal.signal(signal.SIGINT, signal_handler)
 
+def sleep_unless_shutdown(seconds):
+    """Sleep for the given time, waking up early once a shutdown was requested with Ctrl-C."""
+    end = time.time() + seconds
+    while not shutdown_requested and time.time() < end:
+        time.sleep(min(1, end - time.time()))
+
 def create_directory(path):
     """Create directory if it doesn't exist."""
     if not os.path.exists(path):
@@ -40,13 +60,22 @@ def save_logs_to_csv(logs, file_path='download_log.csv'):
                 writer.writerow(["Username", "Shortcode", "File Path", "Timestamp"])
             for log in logs:
                 writer.writerow(log)
+            # Make sure the rows survive a crash right after this call
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
         logging.debug("Logs successfully saved to CSV.")
     except Exception as e:
         logging.error(f"Failed to save logs to CSV: {e}")
 
-def download_user_videos(username):
-    """Download only video posts from the given Instagram username."""
-    logs = []
+def download_user_videos(username, stats):
+    """Download only video posts from the given Instagram username.
+
+    This is a generator: the log rows of each video post are yielded as soon
+    as the post is complete so the caller can commit them right away. Counts
+    of the committed and lost work are kept in `stats`.
+    """
+    stats.update({'posts': 0, 'files': 0, 'lost_files': 0, 'failed': False, 'interrupted': False})
+    in_flight = None  # (target_dir, post) of the post currently being downloaded
     try:
         logging.debug(f"Starting download for {username}. Creating directories...")
 
@@ -60,34 +89,56 @@ def download_user_videos(username):
         logging.debug(f"Profile fetched successfully for {username}.")
 
         # Download only video posts
-        total_files = 0
         posts = profile.get_posts()
         for post in posts:
+            if shutdown_requested:
+                logging.info(f"Stopping {username} early on user request.")
+                stats['interrupted'] = True
+                break
             # Filter and download only video posts
             if post.typename == 'GraphVideo':  # It's a video post
                 logging.debug(f"Downloading video post {post.shortcode} for user {username}.")
-                L.download_post(post, target=base_dir)
-
-                # Log the downloaded video file data
-                for file in os.listdir(base_dir):
-                    if file.startswith(post.shortcode):
-                        file_path = os.path.join(base_dir, file)
-                        logs.append([username, post.shortcode, file_path, time.strftime('%Y-%m-%d %H:%M:%S')])
-                        total_files += 1
-                        logging.debug(f"Downloaded and logged video: {file_path}")
+                target_dir = shard_dir(base_dir, post.shortcode, post.date_utc)
+                create_directory(target_dir)
+                in_flight = (target_dir, post)
+                if PREVIEW_MODE:
+                    # Only the video thumbnail, the video itself is fetched by preview.py hydrate
+                    download_preview(L, post, base_dir, target_dir, os.path.join(base_dir, PREVIEW_MANIFEST))
+                else:
+                    L.download_post(post, target=target_dir)
+                if PACKED_METADATA:
+                    store_post(L, post, base_dir, base_dir)
+                index_post(username, post.shortcode, post.date_utc, post.caption)
+
+                # Hand the downloaded video file data to the caller to be logged right away
+                timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+                logs = [[username, post.shortcode, file_path, timestamp] for file_path in post_files(L, target_dir, post)]
+                for log in logs:
+                    logging.debug(f"Downloaded video file: {log[2]}")
+                record_files(logs)  # Sizes and checksums for the startup integrity check
+                yield logs
+                in_flight = None
+                stats['posts'] += 1
+                stats['files'] += len(logs)
             else:
                 logging.debug(f"Skipping non-video post {post.shortcode} for user {username}.")
 
-        logging.debug(f"Finished downloading for {username}. Total video files: {total_files}")
+        logging.debug(f"Finished downloading for {username}. Total video files: {stats['files']}")
     except instaloader.exceptions.TooManyRequestsException as e:
-        logging.warning(f"Rate limited for {username}. Retrying in 10 minutes...")
-        time.sleep(600)  # Sleep for 10 minutes before retrying
-        return None
+        stats['failed'] = True
+        logging.warning(f"Rate limited for {username} after {stats['posts']} posts. Retrying in 10 minutes...")
+        sleep_unless_shutdown(600)  # Sleep for 10 minutes before retrying
     except Exception as e:
-        logging.error(f"Error downloading posts for {username}: {e}")
-        return None
-
-    return logs  # Return the logs for this user to be written to the CSV file
+        stats['failed'] = True
+        logging.error(f"Error downloading posts for {username} after {stats['posts']} posts: {e}")
+    finally:
+        if stats['failed'] and in_flight is not None:
+            # Whatever the interrupted post left on disk was never logged
+            target_dir, post = in_flight
+            try:
+                stats['lost_files'] = len(post_files(L, target_dir, post))
+            except Exception as e:
+                logging.debug(f"Could not count the files of the interrupted post: {e}")
 
 def read_usernames_from_csv(file_path):
     """Read Instagram usernames from a CSV file."""
@@ -138,13 +189,14 @@ def get_scraping_time_range():
 
 def countdown(seconds):
     """Display a countdown timer."""
-    while seconds:
+    while seconds and not shutdown_requested:
         mins, secs = divmod(seconds, 60)
         time_format = f'{mins:02d}:{secs:02d}'
         print(f"Next scrape in: {time_format}", end='\r')
         time.sleep(1)
         seconds -= 1
-    print("\nScraping next account...")
+    if not shutdown_requested:
+        print("\nScraping next account...")
 
 if __name__ == "__main__":
     # Read usernames from CSV
@@ -163,6 +215,9 @@ if __name__ == "__main__":
         # Get the time range for random sleep intervals
         min_sleep_time, max_sleep_time = get_scraping_time_range()
 
+        # Check the media of earlier runs and download broken files again
+        repair_broken_files(L, stop_requested=lambda: shutdown_requested)
+
         # Randomly shuffle usernames for each run
         random.shuffle(usernames)
         logging.debug(f"Shuffled usernames: {usernames}")
@@ -172,16 +227,22 @@ if __name__ == "__main__":
         log_file_path = 'download_log.csv'  # Specify the log file path here
         logging.debug(f"Log file path: {log_file_path}")
 
+        run_summary = new_run_summary()
+
         # Loop through each username
         for username in usernames:
             logging.debug(f"Starting scraping for {username}.")
             print(f"Scraping {username}...")
-            logs = download_user_videos(username)
+            stats = {}
+            for logs in download_user_videos(username, stats):
+                if logs:
+                    save_logs_to_csv(logs, file_path=log_file_path)  # Save logs to CSV file as soon as each post is done
 
-            if logs:
-                save_logs_to_csv(logs, file_path=log_file_path)  # Save logs to CSV file after scraping the user
-            else:
-                logging.error(f"Failed to scrape or log for {username}.")
+            update_run_summary(run_summary, stats)
+            if stats['failed']:
+                logging.error(f"Failed to scrape {username}; {stats['posts']} posts were logged before the failure.")
+            if shutdown_requested:
+                break
 
             # Add a random sleep time between each download (human-like behavior)
             sleep_time = random.randint(min_sleep_time, max_sleep_time)  # Random sleep within the user-provided range
@@ -189,3 +250,7 @@ if __name__ == "__main__":
             print(f"Waiting for {sleep_time // 60} minutes before scraping the next account...")
 
             # Countdown timer
+            countdown(sleep_time)
+
+        print("Scraping completed for all accounts.")
+        print_run_summary(run_summary)
@@ -0,0 +1,206 @@
+import os
+import json
+import math
+import time
+import random
+import logging
+import argparse
+from collections import deque
+from datetime import datetime
+
+import instaloader
+
+import loadernog
+from integrity import repair_broken_files
+from loadernog import L, download_user_posts, log_to_csv, read_usernames_from_csv, sleep_unless_shutdown
+
+# Polling bounds for a single account (in seconds)
+MIN_INTERVAL = 30 * 60          # Never poll an account more often than every 30 minutes
+MAX_INTERVAL = 3 * 24 * 3600    # Never leave an account unchecked for more than 3 days
+DEFAULT_RATE = 0.5              # Assumed posts per day for accounts we know nothing about
+RATE_SMOOTHING = 0.3            # Weight of the newest observation in the posting rate average
+FEED_PAGE_SIZE = 12             # Posts per feed page Instaloader fetches
+
+def load_registry(path):
+    """Load the target registry from a JSON file."""
+    if not os.path.isfile(path):
+        logging.debug(f"Registry file does not exist yet: {path}")
+        return {}
+    try:
+        with open(path, 'r') as f:
+            registry = json.load(f)
+        logging.debug(f"Loaded {len(registry)} targets from registry.")
+        return registry
+    except Exception as e:
+        logging.error(f"Error reading registry file: {e}")
+        return {}
+
+def save_registry(path, registry):
+    """Write the target registry atomically so a crash never leaves it half written."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(registry, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def sync_registry(registry, usernames):
+    """Add new usernames to the registry and drop the ones no longer listed."""
+    for username in usernames:
+        if username not in registry:
+            logging.debug(f"Adding {username} to the registry.")
+            registry[username] = {
+                'mediacount': None,   # Post count seen on the last check
+                'rate': DEFAULT_RATE, # Smoothed posts per day
+                'last_checked': 0,    # Time of the last profile check
+                'last_change': 0,     # Time the post count last changed
+                'counted_at': 0,      # Time the stored post count was seen
+                'synced_at': None,    # UTC time (ISO) up to which posts were downloaded
+                'next_check': 0,      # Time the account is due again
+            }
+    for username in list(registry):
+        if username not in usernames:
+            logging.debug(f"Removing {username} from the registry.")
+            del registry[username]
+
+def compute_interval(target, now):
+    """Pick the next polling interval from the posting rate and the time since the last change."""
+    rate = max(target['rate'], 1e-3)
+    # Poll about twice per expected gap between posts
+    interval = 86400 / rate / 2
+    # Accounts that stayed quiet for much longer than usual are backed off further
+    if target['last_change']:
+        quiet = now - target['last_change']
+        expected_gap = 86400 / rate
+        if quiet > 2 * expected_gap:
+            interval *= min(quiet / expected_gap, 8)
+    return max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+def update_rate(target, mediacount, now):
+    """Fold the post count change since the stored count into the posting rate and store the new count."""
+    previous = target['mediacount']
+    counted_at = target.get('counted_at') or target['last_checked']  # Registries from before counted_at
+    if previous is not None and counted_at:
+        elapsed_days = max((now - counted_at) / 86400, 1e-3)
+        observed_rate = max(mediacount - previous, 0) / elapsed_days
+        target['rate'] = RATE_SMOOTHING * observed_rate + (1 - RATE_SMOOTHING) * target['rate']
+    if previous is not None and mediacount != previous:
+        target['last_change'] = now
+    target['mediacount'] = mediacount
+    target['counted_at'] = now
+
+def check_target(username, target, log_file_path, max_posts, request_times):
+    """Check one account and download new posts if its post count changed.
+
+    The requests spent are added to `request_times`, also when the check fails
+    or is rate limited (which is raised to the caller).
+    """
+    now = time.time()
+    request_times.append(now)
+    profile = instaloader.Profile.from_username(L.context, username)
+    mediacount = profile.mediacount
+
+    previous = target['mediacount']
+    capped = False
+    if previous is None or mediacount != previous:
+        logging.info(f"Post count for {username} changed ({previous} -> {mediacount}), downloading new posts.")
+        since = datetime.fromisoformat(target['synced_at']) if target['synced_at'] else None
+        sync_start = datetime.utcnow()
+        stats = {}
+        try:
+            for logs in download_user_posts(username, stats, max_posts=max_posts, since=since,
+                                            wait_on_rate_limit=False, profile=profile):
+                if logs:
+                    log_to_csv(log_file_path, logs)  # Log each post as soon as it is done
+        finally:
+            # Feed pages actually walked (the first one is fetched even if it holds nothing new)
+            request_times.extend([time.time()] * max(1, math.ceil(stats.get('walked', 0) / FEED_PAGE_SIZE)))
+        if stats['complete'] and not stats['failed']:
+            target['synced_at'] = sync_start.isoformat()
+            update_rate(target, mediacount, now)
+        # Otherwise the stored post count (and the rate) is kept so the change is retried next time
+        capped = not stats['complete'] and not stats['failed'] and not stats['interrupted']
+    else:
+        logging.debug(f"No new posts for {username}.")
+        update_rate(target, mediacount, now)
+
+    target['last_checked'] = now
+    # A download that stopped at max_posts goes on soon with the posts it did not get to
+    target['next_check'] = now + (MIN_INTERVAL if capped else compute_interval(target, now))
+
+def due_targets(registry, now):
+    """Return the usernames that are due, most active accounts first."""
+    due = [username for username, target in registry.items() if target['next_check'] <= now]
+    # Never-checked accounts go first, then by posting rate
+    due.sort(key=lambda username: (registry[username]['mediacount'] is not None, -registry[username]['rate']))
+    return due
+
+def run_daemon(csv_file, registry_path, log_file_path, requests_per_hour, max_posts, min_gap, max_gap):
+    """Poll every registered account forever, spending the request budget on active accounts first."""
+    registry = load_registry(registry_path)
+    request_times = deque()  # Timestamps of the requests made in the last hour
+
+    # Check the media of earlier runs and download broken files again
+    repair_broken_files(L, stop_requested=lambda: loadernog.shutdown_requested)
+
+    # The first Ctrl-C (handled in loadernog) finishes the current post, then the loop ends
+    while not loadernog.shutdown_requested:
+        # Pick up usernames added to or removed from the CSV file while running
+        usernames = read_usernames_from_csv(csv_file)
+        if usernames:
+            sync_registry(registry, usernames)
+            save_registry(registry_path, registry)
+
+        now = time.time()
+        while request_times and request_times[0] <= now - 3600:
+            request_times.popleft()
+
+        for username in due_targets(registry, now):
+            if loadernog.shutdown_requested:
+                break
+            if len(request_times) >= requests_per_hour:
+                logging.info("Hourly request budget used up, deferring the remaining accounts.")
+                break
+
+            target = registry[username]
+            try:
+                check_target(username, target, log_file_path, max_posts, request_times)
+            except instaloader.exceptions.TooManyRequestsException:
+                logging.warning("Rate limited while checking accounts. Pausing for 10 minutes...")
+                save_registry(registry_path, registry)
+                sleep_unless_shutdown(600)
+                break
+            except Exception as e:
+                logging.error(f"Error checking {username}: {e}")
+                target['last_checked'] = time.time()
+                target['next_check'] = time.time() + MIN_INTERVAL
+            save_registry(registry_path, registry)
+
+            # Random pause between accounts (human-like behavior)
+            sleep_unless_shutdown(random.uniform(min_gap, max_gap))
+
+        # Sleep until the next account is due or the budget frees up
+        now = time.time()
+        wake_at = min((target['next_check'] for target in registry.values()), default=now + MIN_INTERVAL)
+        if len(request_times) >= requests_per_hour:
+            wake_at = max(wake_at, request_times[0] + 3600)
+        sleep_time = max(wake_at - now, 60)
+        logging.debug(f"Sleeping for {int(sleep_time)} seconds until the next check.")
+        sleep_unless_shutdown(sleep_time)
+
+    save_registry(registry_path, registry)
+    logging.info("Watcher stopped.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch Instagram accounts and download new posts as they appear.")
+    parser.add_argument('--usernames', default='instagram_usernames.csv', help="CSV file with one username per row")
+    parser.add_argument('--registry', default='watch_registry.json', help="JSON file holding the polling state")
+    parser.add_argument('--log', default='instagram_downloads_log.csv', help="CSV file the downloads are logged to")
+    parser.add_argument('--requests-per-hour', type=int, default=60, help="Request budget shared by all accounts")
+    parser.add_argument('--max-posts', type=int, default=50, help="Maximum posts to download per check")
+    parser.add_argument('--min-gap', type=float, default=20, help="Minimum pause between accounts in seconds")
+    parser.add_argument('--max-gap', type=float, default=90, help="Maximum pause between accounts in seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    run_daemon(args.usernames, args.registry, args.log, args.requests_per_hour,
+               args.max_posts, args.min_gap, args.max_gap)